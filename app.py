@@ -5,11 +5,35 @@
 # - Brouillon + export CSV récapitulatif
 
 import json
+import os
+import pickle
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Any, List, Optional
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+_UTF8_BOM = b"\xef\xbb\xbf"
+
+# orjson si disponible (parse bien plus rapide), sinon json standard
+try:
+    import orjson
+
+    def json_loads(raw):
+        # orjson refuse le BOM UTF-8 (fréquent avec Excel / outils Windows)
+        if isinstance(raw, bytes) and raw.startswith(_UTF8_BOM):
+            raw = raw[len(_UTF8_BOM):]
+        return orjson.loads(raw)
+except ImportError:
+    def json_loads(raw):
+        return json.loads(raw)
+
 
 # ---------- Répertoires ----------
 BASE_DIR = Path(__file__).parent
@@ -17,22 +41,55 @@ DATA_DIR = BASE_DIR / "client_data"
 UPLOADS_DIR = DATA_DIR / "uploads"
 RESP_DIR = DATA_DIR / "responses"
 DRAFTS_DIR = DATA_DIR / "drafts"
+
+@st.cache_resource(show_spinner=False)
+def _ensured_dirs() -> Set[Path]:
+    # répertoires déjà créés, conservés d'un rerun à l'autre (et entre sessions)
+    return set()
+
+def _ensure(p: Path) -> Path:
+    # évite un mkdir (stat + syscall) pour un répertoire déjà créé par ce processus
+    ensured = _ensured_dirs()
+    if p not in ensured:
+        p.mkdir(parents=True, exist_ok=True)
+        ensured.add(p)
+    return p
+
 for p in (DATA_DIR, UPLOADS_DIR, RESP_DIR, DRAFTS_DIR):
-    p.mkdir(parents=True, exist_ok=True)
+    _ensure(p)
 
 # ---------- Helpers ----------
+RESP_COLS = ("numero","date","libelle","montant","piece","groupe","sous_compte","question","reponse","justificatifs")
+
+_SLUG_STRIP = re.compile(r"[^\w\s-]", re.UNICODE)
+_SLUG_COLLAPSE = re.compile(r"[\s-]+")
+
 def slugify(s: str) -> str:
-    import re
     s = (s or "").strip().lower()
-    s = re.sub(r"[^\w\s-]", "", s)
-    s = re.sub(r"[\s-]+", "_", s).strip("_")
+    s = _SLUG_COLLAPSE.sub("_", _SLUG_STRIP.sub("", s)).strip("_")
     return s or "x"
 
-def load_json_questions(file_or_path) -> Dict[str, Any]:
-    if hasattr(file_or_path, "read"):
-        data = json.load(file_or_path)
-    else:
-        data = json.loads(Path(file_or_path).read_text(encoding="utf-8"))
+def _to_numeric_lossless(col: pd.Series, integer: bool = False) -> pd.Series:
+    # seulement si le JSON contient déjà des nombres : "12,5", "A1", "001"… restent
+    # tels quels (un "001" converti en 1 changerait la clé de brouillon et l'export)
+    present = col.notna() & (col.astype(str).str.strip() != "")
+    if not col[present].map(
+        lambda v: isinstance(v, (int, float)) and not isinstance(v, bool)
+    ).all():
+        return col
+    num = pd.to_numeric(col.where(present))
+    if integer:
+        if not (num.dropna() % 1 == 0).all():
+            return col
+        # entier nullable (pas de 1.0 si un n° manque), non réduit : la colonne reste éditable
+        return num.astype("Int64")
+    return num.astype("float64")
+
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600)
+def _parse_json_bytes(raw: bytes) -> Tuple[str, pd.DataFrame]:
+    # mis en cache par Streamlit (hash des octets) : pas de re-parse à chaque rerun ;
+    # cache partagé entre sessions, donc borné en nombre de fichiers et en durée
+    data = json_loads(raw)
     if "questions" not in data or not isinstance(data["questions"], list):
         raise ValueError("JSON invalide : champ 'questions' manquant.")
     data.setdefault("client_id", "client_sans_id")
@@ -45,60 +102,149 @@ def load_json_questions(file_or_path) -> Dict[str, Any]:
     # colonne Réponse vide au départ
     if "reponse" not in df.columns:
         df["reponse"] = ""
+    # types numériques seulement pour des nombres JSON (aucune valeur réécrite)
+    df["numero"] = _to_numeric_lossless(df["numero"], integer=True)
+    df["montant"] = _to_numeric_lossless(df["montant"])  # float64 : centimes exacts
+    text_cols = ["date","libelle","question","piece","sous_compte","groupe","reponse"]
+    df[text_cols] = df[text_cols].astype("string[pyarrow]")
+    # clé de brouillon stable par question (n° en texte, sinon position)
+    num = df["numero"].astype(str)
+    has_num = df["numero"].notna() & (num.str.strip() != "")
+    df["_qkey"] = num.where(has_num, "anon_" + df.index.astype(str))
     return data["client_id"], df
 
+def load_json_questions(file_or_path) -> Tuple[str, pd.DataFrame]:
+    if hasattr(file_or_path, "getvalue"):
+        raw = file_or_path.getvalue()
+    elif hasattr(file_or_path, "read"):
+        raw = file_or_path.read()
+    else:
+        raw = Path(file_or_path).read_bytes()
+    return _parse_json_bytes(raw)
+
+_LEGACY_FLOAT_KEY = re.compile(r"^(-?\d+)\.0$")
+
+# brouillons stockés en pickle (jamais édités à la main, ne quittent pas le serveur)
+_DRAFT_SUFFIX = ".pkl"
+
 def draft_path(client_id: str) -> Path:
+    return DRAFTS_DIR / f"{slugify(client_id)}{_DRAFT_SUFFIX}"
+
+def _legacy_draft_path(client_id: str) -> Path:
     return DRAFTS_DIR / f"{slugify(client_id)}.json"
 
 def load_draft_answers(client_id: str) -> Dict[str, str]:
     p = draft_path(client_id)
     if p.exists():
         try:
-            j = json.loads(p.read_text(encoding="utf-8"))
-            return j.get("answers", {})
+            return pickle.loads(p.read_bytes())
+        except Exception:
+            return {}
+    # migration unique d'un ancien brouillon JSON
+    legacy = _legacy_draft_path(client_id)
+    if legacy.exists():
+        try:
+            answers = json_loads(legacy.read_bytes()).get("answers", {})
         except Exception:
             return {}
+        # n° en float dans l'ancien format ("3.0") : même clé que _qkey ("3")
+        answers = {_LEGACY_FLOAT_KEY.sub(r"\1", k): v for k, v in answers.items()}
+        write_atomic(p, pickle.dumps(answers, protocol=pickle.HIGHEST_PROTOCOL))
+        return answers
     return {}
 
+def write_atomic(p: Path, payload: bytes):
+    # écrit dans un fichier temporaire unique puis remplace : un rerun interrompu
+    # ne corrompt pas le fichier, et deux sessions ne se marchent pas dessus
+    fd, tmp = tempfile.mkstemp(dir=p.parent, prefix=p.name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+        os.replace(tmp, p)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
 def save_draft_answers(client_id: str, answers: Dict[str, str]):
-    p = draft_path(client_id)
-    p.write_text(json.dumps({"answers": answers}, ensure_ascii=False, indent=2), encoding="utf-8")
+    write_atomic(draft_path(client_id), pickle.dumps(answers, protocol=pickle.HIGHEST_PROTOCOL))
+
+def response_dataset_path(client_id: str) -> Path:
+    # un fragment Parquet par envoi sous ce répertoire
+    return RESP_DIR / slugify(client_id)
 
 def response_csv_path(client_id: str) -> Path:
+    # ancien format (un CSV réécrit à chaque envoi), relu pour le récapitulatif
     return RESP_DIR / f"{slugify(client_id)}.csv"
 
-def append_responses_csv(client_id: str, df: pd.DataFrame):
-    out = response_csv_path(client_id)
-    # colonnes proprement ordonnées
-    cols = ["numero","date","libelle","montant","piece","groupe","sous_compte","question","reponse","justificatifs"]
-    for c in cols:
-        if c not in df.columns: df[c] = ""
-    df = df[cols].copy()
+def append_responses(client_id: str, df: pd.DataFrame):
+    # colonnes proprement ordonnées (manquantes créées vides)
+    df = df.reindex(columns=list(RESP_COLS), fill_value="")
     df.insert(0, "client_id", client_id)
     df.insert(1, "timestamp_utc", pd.Timestamp.utcnow().isoformat())
+    # tout en texte : schéma identique d'un envoi à l'autre, comme l'ancien CSV
+    table = pa.Table.from_pandas(df.astype("string"), preserve_index=False)
+    # nouveau fragment à chaque envoi : rien n'est relu ni réécrit
+    pq.write_to_dataset(table, root_path=str(_ensure(response_dataset_path(client_id))))
 
-    if out.exists():
-        old = pd.read_csv(out)
-        all_df = pd.concat([old, df], ignore_index=True)
-    else:
-        all_df = df
-    all_df.to_csv(out, index=False)
+def responses_csv_bytes(client_id: str) -> Optional[bytes]:
+    parts = []
+    legacy = response_csv_path(client_id)
+    if legacy.exists():
+        parts.append(pd.read_csv(legacy, dtype=str))
+    root = response_dataset_path(client_id)
+    if root.exists() and any(root.iterdir()):
+        cur = pd.read_parquet(root)
+        parts.append(cur.sort_values("timestamp_utc", kind="mergesort"))
+    if not parts:
+        return None
+    all_df = pd.concat(parts, ignore_index=True)
+    return all_df.to_csv(index=False).encode("utf-8")
 
 def save_uploaded_file(client_id: str, numero: Optional[int], uploaded, seq: int) -> str:
-    client_dir = UPLOADS_DIR / slugify(client_id)
-    client_dir.mkdir(parents=True, exist_ok=True)
+    client_dir = _ensure(UPLOADS_DIR / slugify(client_id))
     ext = Path(uploaded.name).suffix.lower()
     num = f"{int(numero):03d}" if pd.notna(numero) and str(numero).strip() != "" else "000"
     fname = f"{slugify(client_id)}_{num}_justif_{seq}{ext}"
     dest = client_dir / fname
+    # copie par blocs de 1 Mio vers le fichier (repart du début du fichier chargé)
+    uploaded.seek(0)
     with open(dest, "wb") as f:
-        f.write(uploaded.getbuffer())
+        shutil.copyfileobj(uploaded, f, length=1024 * 1024)
     return str(dest.relative_to(BASE_DIR))
 
+# ---------- Tableau ----------
+VIEW_COLS = {
+    "numero": "N°",
+    "date": "Date",
+    "libelle": "Libellé",
+    "question": "Question",
+    "montant": "Montant",
+    "piece": "Pièce",
+    "groupe": "Groupe",
+    "sous_compte": "Sous-compte",
+    "reponse": "Réponse"
+}
+VIEW_COL_KEYS = list(VIEW_COLS.keys())
+
+@st.cache_resource(show_spinner=False)
+def _column_config() -> Dict[str, Any]:
+    # le script est ré-exécuté à chaque rerun : config construite une fois par processus
+    return {
+        "numero": st.column_config.NumberColumn(VIEW_COLS["numero"], width="small"),
+        "date": st.column_config.TextColumn(VIEW_COLS["date"], help="AAAA-MM-JJ"),
+        "libelle": st.column_config.TextColumn(VIEW_COLS["libelle"]),
+        "question": st.column_config.TextColumn(VIEW_COLS["question"]),
+        "montant": st.column_config.NumberColumn(VIEW_COLS["montant"], step=0.01),
+        "piece": st.column_config.TextColumn(VIEW_COLS["piece"]),
+        "groupe": st.column_config.TextColumn(VIEW_COLS["groupe"], width="small"),
+        "sous_compte": st.column_config.TextColumn(VIEW_COLS["sous_compte"], width="small"),
+        "reponse": st.column_config.TextColumn(VIEW_COLS["reponse"]),
+    }
+
 # ---------- UI ----------
 st.set_page_config(page_title="Formulaire client", page_icon="🧾", layout="wide")
 st.title("🧾 Formulaire client (vue compacte)")
-st.caption("Répondez dans le tableau. Chargez vos justificatifs par numéro de question.")
+st.caption("Répondez dans le tableau puis sauvegardez. Chargez vos justificatifs par numéro de question.")
 
 # 1) Charger le JSON
 qp = st.query_params
@@ -131,56 +277,42 @@ draft_map = load_draft_answers(client_id)
 if draft_map:
     # applique sur df (par numéro)
     df = df.copy()
-    for i, row in df.iterrows():
-        key = str(row.get("numero",""))
-        if key in draft_map:
-            df.at[i, "reponse"] = draft_map[key]
+    df["reponse"] = df["_qkey"].map(draft_map).fillna(df["reponse"])
 
 # 2) Tableau éditable (réponse texte)
 st.subheader("2) Répondre dans le tableau")
-view_cols = {
-    "numero": "N°",
-    "date": "Date",
-    "libelle": "Libellé",
-    "question": "Question",
-    "montant": "Montant",
-    "piece": "Pièce",
-    "groupe": "Groupe",
-    "sous_compte": "Sous-compte",
-    "reponse": "Réponse"
-}
-df_view = df[list(view_cols.keys())].copy()
-
-edited = st.data_editor(
-    df_view,
-    num_rows="fixed",
-    use_container_width=True,
-    hide_index=True,
-    column_config={
-        "numero": st.column_config.NumberColumn(view_cols["numero"], width="small"),
-        "date": st.column_config.TextColumn(view_cols["date"], help="AAAA-MM-JJ"),
-        "libelle": st.column_config.TextColumn(view_cols["libelle"]),
-        "question": st.column_config.TextColumn(view_cols["question"]),
-        "montant": st.column_config.NumberColumn(view_cols["montant"], step=0.01),
-        "piece": st.column_config.TextColumn(view_cols["piece"]),
-        "groupe": st.column_config.TextColumn(view_cols["groupe"], width="small"),
-        "sous_compte": st.column_config.TextColumn(view_cols["sous_compte"], width="small"),
-        "reponse": st.column_config.TextColumn(view_cols["reponse"]),
-    },
-    key="editor_main"
-)
+df_view = df[VIEW_COL_KEYS].copy()
+
+# formulaire : pas de rerun à chaque saisie, uniquement à la sauvegarde / à l'envoi
+with st.form("answers_form"):
+    edited = st.data_editor(
+        df_view,
+        num_rows="fixed",
+        use_container_width=True,
+        hide_index=True,
+        column_config=_column_config(),
+        key="editor_main"
+    )
+    b1, b2 = st.columns(2)
+    with b1:
+        save_clicked = st.form_submit_button("💾 Sauvegarder le brouillon")
+    with b2:
+        send_clicked = st.form_submit_button("📨 Envoyer / Exporter CSV")
 
-# sauvegarde brouillon (par numéro)
-answers_map = {}
-for _, r in edited.iterrows():
-    key = str(r.get("numero",""))
-    answers_map[key] = r.get("reponse","") or ""
-save_draft_answers(client_id, answers_map)
+# sauvegarde brouillon (par numéro) : aussi à l'envoi, qui soumet le formulaire
+if save_clicked or send_clicked:
+    answers_map = dict(zip(df["_qkey"], edited["reponse"].fillna("")))
+    save_draft_answers(client_id, answers_map)
+    if save_clicked:
+        st.success("Brouillon sauvegardé.")
 
 # 3) Justificatifs : choisir un N° puis uploader (renommage)
 st.subheader("3) Joindre des justificatifs")
-nums = [n for n in edited["numero"].tolist() if pd.notna(n)]
-sel_num = st.selectbox("Choisissez le N° de question", options=sorted(nums) if nums else [])
+# n° du fichier de questions : ne dépend pas des saisies non encore soumises
+nums = df["numero"].dropna().drop_duplicates()
+# n° non numériques ("A1"…) : tri sur le texte pour ne pas mélanger int et str
+nums = nums.sort_values(key=(lambda c: c.astype(str)) if nums.dtype == object else None).tolist()
+sel_num = st.selectbox("Choisissez le N° de question", options=nums)
 ups = st.file_uploader(
     "Déposer vos fichiers pour cette question",
     type=["pdf","png","jpg","jpeg","webp","tif","tiff","doc","docx","xls","xlsx","csv","txt"],
@@ -189,10 +321,12 @@ ups = st.file_uploader(
 )
 if sel_num and ups:
     start_seq = 1
-    saved = []
-    for i, f in enumerate(ups, start=start_seq):
-        rel = save_uploaded_file(client_id, sel_num, f, i)
-        saved.append(rel)
+    # écritures indépendantes : en parallèle, ordre conservé par ex.map
+    with ThreadPoolExecutor(max_workers=min(8, len(ups))) as ex:
+        saved = list(ex.map(
+            lambda args: save_uploaded_file(client_id, sel_num, args[1], args[0]),
+            enumerate(ups, start=start_seq),
+        ))
     if saved:
         st.success(f"{len(saved)} fichier(s) enregistré(s) pour la question {int(sel_num)}.")
         st.write("Fichiers :", *[f"`{p}`" for p in saved], sep="\n")
@@ -201,15 +335,16 @@ st.divider()
 
 # 4) Finaliser
 st.subheader("4) Finaliser / Export CSV")
-if st.button("📨 Envoyer / Exporter CSV"):
-    # merge des réponses dans df
-    df_out = df.copy()
-    df_out = df_out.merge(edited[["numero","reponse"]], on="numero", how="left")
+if not send_clicked:
+    st.caption("Utilisez « 📨 Envoyer / Exporter CSV » sous le tableau pour enregistrer vos réponses.")
+else:
+    # réponses soumises avec le formulaire (mêmes lignes, même ordre : num_rows="fixed")
     # pas de suivi centralisé des fichiers déjà envoyés (stockés au disque), mais on met un placeholder
-    df_out["justificatifs"] = ""  # chemins des fichiers non centralisés ici
-    append_responses_csv(client_id, df_out)
+    df_out = df.assign(reponse=edited["reponse"].to_numpy(), justificatifs="")
+    append_responses(client_id, df_out)
     st.success("Vos réponses ont été enregistrées.")
-    out = response_csv_path(client_id)
-    if out.exists():
-        with open(out, "rb") as fh:
-            st.download_button("Télécharger le récapitulatif (CSV)", fh, file_name=out.name)
+    recap = responses_csv_bytes(client_id)
+    if recap is not None:
+        st.download_button(
+            "Télécharger le récapitulatif (CSV)", recap, file_name=f"{slugify(client_id)}.csv"
+        )